@@ -0,0 +1,129 @@
+"""Parsers for the two NPI inputs: the MSCI deal text file and the Dividend Receivable Excel report.
+
+Both take the uploaded file's bytes and have no Streamlit dependency; streamlit_app.py memoises them.
+"""
+import io
+import re
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+# Column layout of the pipe-delimited rows in the MSCI deal file
+DEAL_COLUMNS = [
+    'calc_date', 'msci_index_code', 'msci_dividend_code', 'xd_date', 'reinvestment_in_index_date',
+    'dividend_description', 'msci_security_code', 'msci_timeseries_code', 'msci_issuer_code',
+    'security_name', 'bb_ticker', 'dividend_ISO_currency_symbol', 'unadjusted_dividend_amount',
+    'dividend_sub_unit', 'dividend_adjustment_factor', 'adjusted_grs_dividend_amount',
+    'withholding_tax_rate', 'adj_net_dividend_amount_int', 'adj_net_dividend_amount_dom',
+    'purified_dividend_adjust_fact', 'purified_adj_grs_div_amount', 'purified_adj_net_div_amnt_int',
+    'purified_adj_net_div_amnt_dom', 'gross_amount_to_purify', 'net_intl_amount_to_purify',
+    'net_domestic_amount_to_purify', 'isin', 'reserved_1', 'reserved_2', 'reserved_3', 'reserved_4',
+    'reserved_5', 'reserved_6', 'reserved_7', 'reserved_8', 'reserved_9', 'reserved_10',
+    'reserved_11', 'reserved_12', 'reserved_13', 'reserved_14', 'reserved_15', 'reserved_16',
+    'reserved_17', 'reserved_18', 'reserved_19'
+]
+
+# Only these deal columns are used downstream; the rest are dropped at parse time
+DEAL_USECOLS = ['xd_date', 'net_domestic_amount_to_purify', 'isin']
+
+# Detail columns of the Dividend Receivable report that filtering, matching and NPI rely on
+REPORT_REQUIRED_COLUMNS = ['Security Sedol', 'Ex Date', 'Accured Income Net (Base)']
+
+# Data rows are the lines wrapped in '|'; everything else in the file is header/footer
+_DEAL_ROW_RE = re.compile(rb'^\|[^\r\n]*', re.MULTILINE)
+# Whitespace padding around the '|' delimiters: every character str.strip() removes (NBSP and other Unicode
+# spaces included), as UTF-8 byte sequences. Line breaks are left out since rows are already split on them.
+_PADDING_BYTES = b'|'.join(
+    re.escape(chr(c).encode('utf-8')) for c in range(sys.maxunicode + 1) if chr(c).isspace() and chr(c) not in '\r\n'
+)
+_PIPE_PADDING_RE = re.compile(rb'(?:' + _PADDING_BYTES + rb')*\|(?:' + _PADDING_BYTES + rb')*')
+
+# A '|' line needs at least this many columns (counting the empty ones outside the bracketing pipes) to reach
+# the isin field; anything shorter, such as a '|----|' separator, carries no usable MSCI data
+_MIN_DEAL_ROW_COLUMNS = DEAL_COLUMNS.index('isin') + 3
+
+def parse_deal_file(raw):
+    """Parse the '|'-wrapped data rows of the MSCI deal file (raw bytes).
+
+    Returns (deal_df, skipped_rows), where skipped_rows counts '|' lines too short to reach the isin field.
+    """
+    # Pick out the data rows straight from the bytes (no whole-file decode) and hand them to Arrow's
+    # multi-threaded CSV reader in one go
+    deal_lines = _DEAL_ROW_RE.findall(raw)
+    # An empty or header-only file would otherwise only fail inside Arrow with a bare "Empty CSV file"
+    if not deal_lines:
+        raise ValueError("MSCI deal file contains no '|'-delimited data rows")
+    deal_rows = _PIPE_PADDING_RE.sub(b'|', b'\n'.join(deal_lines))
+
+    # Arrow insists on the full field count. Short rows that still reach isin were padded by the old
+    # list-of-lists parser, so they are set aside here and padded below; shorter lines are counted and dropped,
+    # and over-long rows fail the parse as they always did.
+    short_rows = []
+    skipped_rows = []
+
+    def handle_invalid_row(row):
+        if row.actual_columns > row.expected_columns:
+            return 'error'
+        if row.actual_columns >= _MIN_DEAL_ROW_COLUMNS:
+            short_rows.append(row.text)
+        else:
+            skipped_rows.append(row.number)
+        return 'skip'
+
+    # The bracketing pipes produce an empty column at each end, named here only to be skipped by include_columns.
+    # The kept columns are read as plain strings so a malformed cell can't abort the whole parse.
+    deal_table = pa_csv.read_csv(
+        pa.py_buffer(deal_rows),
+        read_options=pa_csv.ReadOptions(column_names=['_lead', *DEAL_COLUMNS, '_trail']),
+        parse_options=pa_csv.ParseOptions(delimiter='|', quote_char=False, invalid_row_handler=handle_invalid_row),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=DEAL_USECOLS, column_types={column: pa.string() for column in DEAL_USECOLS},
+            strings_can_be_null=False,
+        ),
+    )
+    deal_df = deal_table.to_pandas()
+    if short_rows:
+        kept_positions = [DEAL_COLUMNS.index(column) for column in DEAL_USECOLS]
+        padded = [
+            [fields[i] if i < len(fields) else '' for i in kept_positions]
+            for fields in (text.split('|')[1:-1] for text in short_rows)
+        ]
+        deal_df = pd.concat([deal_df, pd.DataFrame(padded, columns=DEAL_USECOLS)], ignore_index=True)
+
+    # Bad or blank dates become NaT (and so fall out of the date filter); bad or blank amounts become NaN,
+    # which the per-ISIN sum treats as 0. A blank isin stays ''.
+    deal_df['xd_date'] = pd.to_datetime(deal_df['xd_date'], format='%Y%m%d', errors='coerce')
+    deal_df['net_domestic_amount_to_purify'] = pd.to_numeric(deal_df['net_domestic_amount_to_purify'], errors='coerce')
+    deal_df['isin'] = deal_df['isin'].astype('string[pyarrow]')
+    return deal_df, len(skipped_rows)
+
+def load_report(raw):
+    """Read the Dividend Receivable Excel report (raw bytes) and split it into (summary, details)."""
+    report_df = pd.read_excel(io.BytesIO(raw), header=None, engine='calamine') # Rust-based reader, much faster than openpyxl
+
+    # Take the first matching label straight from the index rather than materialising the matching rows
+    details_start_index = report_df.index[report_df[0] == 'DIVIDENDS RECIEVABLE DEATAILS'][0]
+    details_header_index = details_start_index + 2
+    details_data_start_index = details_header_index + 1
+
+    # Bail out before slicing or converting anything if the details header lacks a column we need
+    details_header = report_df.iloc[details_header_index]
+    missing_columns = [column for column in REPORT_REQUIRED_COLUMNS if column not in details_header.values]
+    if missing_columns:
+        raise ValueError(f"Dividend Receivable report is missing required column(s): {', '.join(missing_columns)}")
+
+    # No deep copies: the summary is only read (the total row is inserted into a fresh frame), and the
+    # details only ever have whole columns replaced, which a shallow copy handles without touching report_df
+    summary_df = report_df.iloc[:details_header_index]
+    details_df = report_df.iloc[details_data_start_index:].copy(deep=False)
+    details_df.columns = details_header
+
+    # Coerce the columns used for filtering, matching and NPI here, so the app's cached loader does it once per upload
+    # (missing Sedols stay NA rather than becoming the string 'nan'; categorical Sedols let the join
+    # compare integer codes instead of hashing strings)
+    details_df['Security Sedol'] = details_df['Security Sedol'].astype('string[pyarrow]').astype('category')
+    details_df['Ex Date'] = pd.to_datetime(details_df['Ex Date'], errors='coerce')
+    details_df['Accured Income Net (Base)'] = pd.to_numeric(details_df['Accured Income Net (Base)'], errors='coerce')
+    return summary_df, details_df
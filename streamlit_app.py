@@ -2,8 +2,105 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import io
-import inspect # Import the inspect module
+import os
 import datetime # Import datetime module
+import npi_parser
+
+# Parsing is memoised on the uploaded bytes, so reruns (e.g. changing the date) skip it
+parse_deal_file = st.cache_data(max_entries=4, show_spinner=False)(npi_parser.parse_deal_file)
+load_report = st.cache_data(max_entries=4, show_spinner=False)(npi_parser.load_report)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def build_npi_report(deal_raw, excel_raw, calculation_date):
+    """Merge the MSCI purification factors into the report as of calculation_date.
+
+    Returns (issues, details_df_final, report_xlsx). The whole result is memoised, so reruns that
+    don't change the inputs (e.g. clicking the download button) skip the merge and Excel write entirely.
+    details_df_final is empty and report_xlsx is None when nothing survives the date filter.
+    """
+    issues = []
+
+    # --- 1. Read deal data from text file ---
+    deal_df, skipped_deal_rows = parse_deal_file(deal_raw)
+    if skipped_deal_rows:
+        issues.append(f"{skipped_deal_rows} '|' line(s) in the text file were too short to contain an ISIN and were left out of the NPI calculation.")
+
+    # Filter deal_df based on calculation_date
+    deal_df_filtered = deal_df[deal_df['xd_date'] <= pd.to_datetime(calculation_date)]
+
+    # Aggregate net_domestic_amount_to_purify for each ISIN in the filtered deal data (blank amounts sum as 0)
+    # Keyed on isin so the lookup below can join against the index
+    deal_subset_aggregated = deal_df_filtered.groupby('isin', observed=True, sort=False)[['net_domestic_amount_to_purify']].sum()
+    deal_subset_aggregated.rename(columns={'net_domestic_amount_to_purify': 'aggregated_net_domestic_amount_to_purify'}, inplace=True)
+
+    # --- 2. Read report data from Excel file and split into summary and details ---
+    summary_df, details_df = load_report(excel_raw)
+
+    # Filter details_df based on calculation_date
+    details_df_filtered_by_date = details_df[details_df['Ex Date'] <= pd.to_datetime(calculation_date)]
+
+    # --- Validation Checks ---
+    # Check 1: Security Count Check (using filtered dataframes)
+    excel_securities = set(details_df_filtered_by_date['Security Sedol'].unique())
+    deal_securities = set(deal_subset_aggregated.index) # Use aggregated deal_subset for this check
+
+    if len(excel_securities) != len(deal_securities):
+        issues.append(f"Security count mismatch! Excel file (filtered by date) has {len(excel_securities)} unique securities, while filtered and aggregated text file has {len(deal_securities)}.")
+        issues.append(f"Securities only in Excel (filtered): {excel_securities - deal_securities}")
+        issues.append(f"Securities only in Filtered Text (aggregated): {deal_securities - excel_securities}")
+
+    # New Check: Duplicate ISINs in original deal_df (before aggregation)
+    duplicate_isins_original = deal_df[deal_df.duplicated(subset=['isin'], keep=False)]['isin'].unique()
+    if len(duplicate_isins_original) > 0:
+        issues.append(f"Multiple entries found for the following ISIN(s) in the original text file: {', '.join(duplicate_isins_original)}.")
+        issues.append("These have been aggregated for NPI calculation. This might lead to unexpected results if not handled as intended.")
+
+    # --- 4. Merge and calculate ---
+    # Only ISINs present in the filtered report can match, so shrink the lookup side first
+    deal_subset_aggregated = deal_subset_aggregated[deal_subset_aggregated.index.isin(excel_securities)]
+    deal_subset_aggregated.index = deal_subset_aggregated.index.astype(details_df['Security Sedol'].dtype) # same categories as the Sedols
+
+    # Join the date-filtered Excel details onto the isin-indexed aggregated MSCI data (one row per isin, so no fan-out)
+    # join keeps the report's row labels; renumber 0..n-1 as pd.merge did, so the preview's row numbers are unchanged
+    merged_df = details_df_filtered_by_date.join(deal_subset_aggregated, on='Security Sedol', how='left', validate='m:1').reset_index(drop=True)
+
+    if merged_df.empty:
+        return issues, merged_df, None
+
+    # Pull both inputs out as float64 arrays with NaN read as 0 and multiply them directly, so there are no
+    # separate fillna passes and no index alignment for NPI Base. Deliberately float64, not float32: these are
+    # monetary amounts summed into Total NPI, and float32's ~7 significant digits would lose cents on large accruals.
+    purify_factor = merged_df['aggregated_net_domestic_amount_to_purify'].to_numpy(dtype=np.float64, na_value=0.0)
+    accrued_income = merged_df['Accured Income Net (Base)'].to_numpy(dtype=np.float64, na_value=0.0)
+    merged_df['aggregated_net_domestic_amount_to_purify'] = purify_factor
+    merged_df['NPI Base'] = np.multiply(purify_factor, accrued_income)
+
+    # --- 5. Calculate total ---
+    details_df_final = merged_df
+    npi_base_total = details_df_final['NPI Base'].sum()
+
+    # --- 6. Add total to summary ---
+    total_row_index = summary_df.index[summary_df[0] == 'Total'][0]
+    new_row = [None] * summary_df.shape[1]
+    new_row[0], new_row[3] = 'Total NPI', npi_base_total
+
+    # Insert the row straight into the (small) underlying array rather than slicing and concatenating frames
+    summary_df = pd.DataFrame(np.insert(summary_df.to_numpy(dtype=object), total_row_index + 1, new_row, axis=0), columns=summary_df.columns)
+
+    # --- 7. Write the enriched workbook ---
+    output_excel_buffer = io.BytesIO()
+    # xlsxwriter streams cells into the xlsx XML instead of building openpyxl's per-cell object model.
+    # constant_memory is not enabled: pandas writes cells column by column, which that row-at-a-time mode would drop.
+    with pd.ExcelWriter(output_excel_buffer, engine='xlsxwriter') as writer:
+        summary_df.to_excel(writer, index=False, header=False, sheet_name='Sheet1')
+        details_df_final.to_excel(writer, index=False, header=True, sheet_name='Sheet1', startrow=len(summary_df))
+    return issues, details_df_final, output_excel_buffer.getvalue()
+
+@st.cache_data(show_spinner=False)
+def read_source(path, mtime):
+    """Return the text of the given source file (read once per modification time, not on every rerun)."""
+    with open(path, encoding="utf-8") as f:
+        return f.read()
 
 st.set_page_config(layout="wide")
 st.title("Dividend Receivable Report Generator")
@@ -34,121 +131,22 @@ if deal_file and excel_file:
     st.success("Files uploaded successfully!")
 
     try:
-        # --- 1. Read deal data from text file ---
-        deal_lines = deal_file.getvalue().decode("utf-8").splitlines()
-
-        data = []
-        for line in deal_lines:
-            if line.startswith('|'):
-                fields = [x.strip() for x in line.split('|')[1:-1]]
-                data.append(fields)
-
-        columns = [
-            'calc_date', 'msci_index_code', 'msci_dividend_code', 'xd_date', 'reinvestment_in_index_date',
-            'dividend_description', 'msci_security_code', 'msci_timeseries_code', 'msci_issuer_code',
-            'security_name', 'bb_ticker', 'dividend_ISO_currency_symbol', 'unadjusted_dividend_amount',
-            'dividend_sub_unit', 'dividend_adjustment_factor', 'adjusted_grs_dividend_amount',
-            'withholding_tax_rate', 'adj_net_dividend_amount_int', 'adj_net_dividend_amount_dom',
-            'purified_dividend_adjust_fact', 'purified_adj_grs_div_amount', 'purified_adj_net_div_amnt_int',
-            'purified_adj_net_div_amnt_dom', 'gross_amount_to_purify', 'net_intl_amount_to_purify',
-            'net_domestic_amount_to_purify', 'isin', 'reserved_1', 'reserved_2', 'reserved_3', 'reserved_4',
-            'reserved_5', 'reserved_6', 'reserved_7', 'reserved_8', 'reserved_9', 'reserved_10',
-            'reserved_11', 'reserved_12', 'reserved_13', 'reserved_14', 'reserved_15', 'reserved_16',
-            'reserved_17', 'reserved_18', 'reserved_19'
-        ]
-        deal_df = pd.DataFrame(data, columns=columns)
-
-        # Convert xd_date to datetime objects for filtering
-        deal_df['xd_date'] = pd.to_datetime(deal_df['xd_date'], format='%Y%m%d', errors='coerce')
-
-        # Filter deal_df based on calculation_date
-        deal_df_filtered = deal_df[deal_df['xd_date'] <= pd.to_datetime(calculation_date)]
-
-        # Aggregate net_domestic_amount_to_purify for each ISIN in the filtered deal data
-        deal_df_filtered['net_domestic_amount_to_purify'] = pd.to_numeric(deal_df_filtered['net_domestic_amount_to_purify'], errors='coerce').fillna(0)
-        deal_subset_aggregated = deal_df_filtered.groupby('isin')['net_domestic_amount_to_purify'].sum().reset_index()
-        deal_subset_aggregated.rename(columns={'net_domestic_amount_to_purify': 'aggregated_net_domestic_amount_to_purify'}, inplace=True)
-
-        # --- 2. Read report data from Excel file ---
-        excel_data = io.BytesIO(excel_file.getvalue())
-        report_df = pd.read_excel(excel_data, header=None)
-
-        # --- 3. Split report into summary and details ---
-        details_start_index = report_df[report_df[0] == 'DIVIDENDS RECIEVABLE DEATAILS'].index[0]
-        details_header_index = details_start_index + 2
-        details_data_start_index = details_header_index + 1
-
-        summary_df = report_df.iloc[:details_header_index].copy()
-        details_df = report_df.iloc[details_data_start_index:].copy()
-        details_df.columns = report_df.iloc[details_header_index]
-
-        # Ensure 'Security Sedol' and 'Ex Date' are correct types for filtering and merging
-        details_df['Security Sedol'] = details_df['Security Sedol'].astype(str)
-        details_df['Ex Date'] = pd.to_datetime(details_df['Ex Date'], errors='coerce')
-
-        # Filter details_df based on calculation_date
-        details_df_filtered_by_date = details_df[details_df['Ex Date'] <= pd.to_datetime(calculation_date)]
-
-        # --- Validation Checks ---
-        # Check 1: Security Count Check (using filtered dataframes)
-        excel_securities = set(details_df_filtered_by_date['Security Sedol'].unique())
-        deal_securities = set(deal_subset_aggregated['isin'].unique()) # Use aggregated deal_subset for this check
-
-        if len(excel_securities) != len(deal_securities):
-            st.warning(f"Security count mismatch! Excel file (filtered by date) has {len(excel_securities)} unique securities, while filtered and aggregated text file has {len(deal_securities)}.")
-            st.warning(f"Securities only in Excel (filtered): {excel_securities - deal_securities}")
-            st.warning(f"Securities only in Filtered Text (aggregated): {deal_securities - excel_securities}")
-            # Do not stop, just warn
-
-        # New Check: Duplicate ISINs in original deal_df (before aggregation)
-        duplicate_isins_original = deal_df[deal_df.duplicated(subset=['isin'], keep=False)]['isin'].unique()
-        if len(duplicate_isins_original) > 0:
-            st.warning(f"Multiple entries found for the following ISIN(s) in the original text file: {', '.join(duplicate_isins_original)}.")
-            st.warning("These have been aggregated for NPI calculation. This might lead to unexpected results if not handled as intended.")
-            # Do not stop, just warn
-
-        # --- 4. Merge and calculate ---
-        # Merge the date-filtered Excel details with the aggregated MSCI data
-        merged_df = pd.merge(details_df_filtered_by_date, deal_subset_aggregated, left_on='Security Sedol', right_on='isin', how='left')
-
-        if merged_df.empty:
+        issues, details_df_final, report_xlsx = build_npi_report(deal_file.getvalue(), excel_file.getvalue(), calculation_date)
+        for message in issues:
+            st.warning(message) # Do not stop, just warn
+
+        if details_df_final.empty:
             st.warning("No matching ISINs found between the uploaded files (after date filtering). Please check the 'Security Sedol' column in your Excel file and 'isin' in your text file, and the selected NPI Calculation Date.")
             st.stop()
 
-        merged_df['aggregated_net_domestic_amount_to_purify'] = pd.to_numeric(merged_df['aggregated_net_domestic_amount_to_purify'].replace('', np.nan), errors='coerce')
-        merged_df['Accured Income Net (Base)'] = pd.to_numeric(merged_df['Accured Income Net (Base)'], errors='coerce')
-        merged_df['NPI Base'] = merged_df['aggregated_net_domestic_amount_to_purify'] * merged_df['Accured Income Net (Base)']
-
-        # --- 5. Clean up and calculate total ---
-        merged_df['aggregated_net_domestic_amount_to_purify'] = merged_df['aggregated_net_domestic_amount_to_purify'].fillna(0)
-        merged_df['NPI Base'] = merged_df['NPI Base'].fillna(0)
-        details_df_final = merged_df.drop(columns=['isin']) # drop redundant isin column
-        npi_base_total = details_df_final['NPI Base'].sum()
-
-        # --- 6. Add total to summary ---
-        total_row_index = summary_df[summary_df[0] == 'Total'].index[0]
-        new_row_data = {
-            0: 'Total NPI',
-            3: npi_base_total
-        }
-        new_row = pd.DataFrame(new_row_data, index=[0])
-
-        summary_df = pd.concat([summary_df.iloc[:total_row_index+1], new_row, summary_df.iloc[total_row_index+1:]]).reset_index(drop=True)
-
         # --- Display Report Details Preview ---
         st.subheader("Report Details Preview (Filtered by NPI Calculation Date):")
         st.dataframe(details_df_final)
 
-        # --- 7. Provide download button ---
-        output_excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(output_excel_buffer, engine='openpyxl') as writer:
-            summary_df.to_excel(writer, index=False, header=False, sheet_name='Sheet1')
-            details_df_final.to_excel(writer, index=False, header=True, sheet_name='Sheet1', startrow=len(summary_df))
-        output_excel_buffer.seek(0)
-
+        # --- Provide download button ---
         st.download_button(
             label="Download Generated Report",
-            data=output_excel_buffer,
+            data=report_xlsx,
             file_name="Dividends_Receivable_Report_with_NPI.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
@@ -161,8 +159,10 @@ st.markdown("---") # Add a horizontal rule
 
 # --- Source Code Expander ---
 with st.expander("View Application Source Code"):
-    source_code = inspect.getsource(inspect.currentframe())
+    # The mtime is part of the cache key, so an edited file is re-read instead of serving stale source
+    source_code = read_source(__file__, os.path.getmtime(__file__))
     st.code(source_code, language='python')
+    st.code(read_source(npi_parser.__file__, os.path.getmtime(npi_parser.__file__)), language='python')
 
 st.markdown("---") # Add another horizontal rule
 